@@ -2,8 +2,16 @@
 
 from distutils.core import setup
 
+ext_modules = []
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(['thrift_client/_speedups.pyx'])
+except ImportError:
+    pass # Cython is optional; the pure-Python dispatch path is used instead.
+
 setup(
     name='thrift_client',
     version='0.1',
-    packages=['thrift_client']
+    packages=['thrift_client'],
+    ext_modules=ext_modules
     )
\ No newline at end of file
@@ -0,0 +1,26 @@
+# cython: language_level=2
+"""Optional Cython speedups for the HashClient dispatch path. The pure
+Python fallbacks in thrift_client.py compute exactly the same values, so
+routing does not depend on whether this module was built."""
+
+def hash_key(tuple args, dict kwargs):
+    """Default hash key for a call: the hash of the positional arguments
+    combined with the hash of the keyword items. Must stay in lockstep
+    with the pure-Python default in HashClient._build_key_fn."""
+    return hash(args) ^ hash(frozenset(kwargs.items()))
+
+def ring_lookup(list ring_hashes, list ring_servers, long hashval):
+    """Returns the server whose ring point follows hashval, wrapping around
+    at the end of the ring; a C-level bisect over the sorted ring points."""
+    cdef Py_ssize_t lo = 0
+    cdef Py_ssize_t hi = len(ring_hashes)
+    cdef Py_ssize_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if <long>ring_hashes[mid] <= hashval:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == len(ring_servers):
+        lo = 0
+    return ring_servers[lo]
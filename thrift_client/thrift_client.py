@@ -1,31 +1,85 @@
 __doc__ = """Classes for common use cases of Thrift clients."""
 __author__ = """Albert Sheu"""
 
+import bisect
+import collections
 import logging
+import Queue
 import random
 import socket
 import threading
+import time
 
+from thrift.Thrift import TException
 from thrift.transport import TTransport
 from thrift.transport import TSocket
 from thrift.protocol import TBinaryProtocol, TProtocol
 
+try:
+    import _speedups
+except ImportError:
+    _speedups = None # Compiled speedups are optional; see setup.py.
+
+_log = logging.getLogger('thrift_client')
+
+# Exceptions that indicate a failed call rather than a client-side bug:
+# network errors, transport breakage, and errors raised by the Thrift
+# server. Anything else propagates untouched.
+_RPC_ERRORS = (IOError, socket.error, TTransport.TTransportException, TException)
+
 _DEFAULT_TIMEOUT = 60001
 
+# Ring points per server in HashClient's consistent-hash ring. More points
+# spread keys more evenly at the cost of a larger ring to rebuild.
+_VIRTUAL_NODES = 160
+
+_canonicalize_cache = {}
+
 def _canonicalize_hostport(host, port):
     """Turn instances of hostname:port into two separate objects,
     string of the host, and int of the port. Valid host, port arguments
-    are returned. Idempotent function."""
+    are returned. Idempotent function. Results, including the DNS lookup,
+    are cached, since the same handful of addresses gets canonicalized
+    over and over as pools are built up and scanned by remove_server."""
+    try:
+        return _canonicalize_cache[(host, port)]
+    except KeyError:
+        pass
     if port is not None:
-        host = socket.gethostbyname(host)
-        return host, port
-    elif port is None and ':' in host:
-        host, port = host.split(':')
-        host = socket.gethostbyname(host)
-        port = int(port)
-        return host, port
+        resolved = (socket.gethostbyname(host), port)
     else:
-        raise ValueError('Invalid host, port pair: %r', (host, port))
+        hostname, sep, portstr = host.rpartition(':')
+        if not sep:
+            raise ValueError('Invalid host, port pair: %r' % ((host, port),))
+        resolved = (socket.gethostbyname(hostname), int(portstr))
+    if len(_canonicalize_cache) < 1024:
+        _canonicalize_cache[(host, port)] = resolved
+    return resolved
+
+if _speedups is not None:
+    _default_key_fn = _speedups.hash_key
+else:
+    def _default_key_fn(args, kwargs):
+        """Pure-Python twin of _speedups.hash_key; must compute the same
+        value so routing does not depend on whether the extension built."""
+        return hash(args) ^ hash(frozenset(kwargs.items()))
+
+def _rpc_names(protocol):
+    """Lists the RPC method names exposed by the protocol module's generated
+    Client class, read off its send_* methods."""
+    prefix = 'send_'
+    return [attr[len(prefix):] for attr in dir(protocol.Client)
+            if attr.startswith(prefix)]
+
+def _prime_dispatchers(client, protocol):
+    """Creates dispatchers up front for every RPC named by the generated
+    Client class, so hot calls never take the __getattr__ fallback path.
+    Names shadowing real attributes are skipped, and unknown or dynamic
+    method names still work through __getattr__."""
+    for m in _rpc_names(protocol):
+        if m.startswith('_') or hasattr(client.__class__, m) or m in client.__dict__:
+            continue
+        client.__dict__[m] = client._make_dispatcher(m)
 
 class InvalidServerName(Exception):
     """Raised when a call is attempted to a server that's not known."""
@@ -35,10 +89,39 @@ class ClientDisabledError(Exception):
     """Raised when a function call is attempted on a disabled client."""
     pass
 
-class ThriftResponse():
+class _Connection(object):
+    """One pooled connection to a Thrift server: the generated client, the
+    transport stack it speaks through and the socket underneath it, plus the
+    time it was established for keepalive accounting."""
+    __slots__ = ('client', 'transport', 'socket', 'created', 'local_addr')
+
+    def __init__(self, client, transport, sock):
+        self.client = client
+        self.transport = transport
+        self.socket = sock
+        self.created = time.time()
+        # Bound local address, filled in once at connect time so log and
+        # debug formatting never has to pay a getsockname syscall per use.
+        self.local_addr = None
+
+    def is_open(self):
+        """Returns whether the transport still considers itself open."""
+        return self.transport.isOpen()
+
+    def close(self):
+        """Closes the transport stack and the socket underneath it."""
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+class ThriftResponse(object):
     """Object representing a return value by a Thrift server. Includes
     the client object that made the request, as well as the object
-    returned by the thrift call."""
+    returned by the thrift call. One of these is allocated per server per
+    fan-out call, so the class is slotted to keep instances small."""
+    __slots__ = ('server', 'response')
+
     def __init__(self, server, response):
         self.server = server
         self.response = response
@@ -62,6 +145,8 @@ class ThriftExceptionResponse(ThriftResponse):
     raised, either by the Thrift server or by the underlying transport.
     Calling .value() on an ExceptionResponse will raise the exception
     originally raised."""
+    __slots__ = ('exception',)
+
     def __init__(self, server, exception):
         self.server = server
         self.exception = exception
@@ -83,8 +168,19 @@ class SimpleClient(threading.local):
     to a single Thrift server of the given protocol. host and port represent the
     location of the Thrift service. frame indicates whether the service is
     running under a TFramedTransport. timeout indicates the socket timeout
-    factor on the socket connect(), send(), and recv()."""
-    def __init__(self, protocol, host, port=None, frame=False, log_filename=None, timeout=None, name=None):
+    factor on the socket connect(), send(), and recv(). max_conn bounds the
+    number of warm connections kept around between calls, and keepalive is
+    the number of seconds after which a pooled connection is considered
+    stale and reconnected (None keeps connections indefinitely). After
+    fail_threshold consecutive failed calls the client trips open and
+    refuses calls for fail_cooldown seconds, so a dead server stops
+    costing a connect timeout on every attempt; fail_threshold=None
+    disables the breaker. socket_opts is an optional list of
+    (level, option, value) tuples applied to every new connection on top
+    of the defaults."""
+    def __init__(self, protocol, host, port=None, frame=False, log_filename=None,
+                 timeout=None, name=None, max_conn=10, keepalive=None,
+                 fail_threshold=5, fail_cooldown=30, socket_opts=None):
         self.protocol = protocol
         self.host, self.port = _canonicalize_hostport(host, port)
         self.frame = frame
@@ -92,8 +188,28 @@ class SimpleClient(threading.local):
         self.file = None
         self.enabled = True
         self.name = name or '%s-%d' % (self.protocol.__name__, id(self))
+        self.max_conn = max_conn
+        self.keepalive = keepalive
+        self.fail_threshold = fail_threshold
+        self.fail_cooldown = fail_cooldown
+        self.socket_opts = socket_opts or []
+        self._fail_count = 0
+        self._open_until = 0
+        self._local_addr = None
+        self._pool = collections.deque()
+        self._pool_lock = threading.Lock()
+        # host, port and protocol never change, so hash and repr are fixed
+        # at construction; clients are hashed a lot when used as dict keys.
+        self._hash = hash((self.host, self.port, self.protocol))
+        self._repr = '<%s client %s:%d>' % (self.protocol.__name__, self.host, self.port)
+        self._file_client = None
+        self._file_lock = threading.Lock()
         if log_filename:
             self.file = open(log_filename, 'ab')
+            # Wrap the logfile in a transport once; rebuilding it per call
+            # just to append a record dominates high-volume logging.
+            self._file_client = self._connect_file()
+        _prime_dispatchers(self, protocol)
 
     def enable(self):
         """Allows function calls to be made through the Thrift client."""
@@ -105,12 +221,28 @@ class SimpleClient(threading.local):
         self.enabled = False
 
     def is_enabled(self):
-        """Returns whether the client has been enabled or not."""
-        return self.enabled
+        """Returns whether the client has been enabled or not. A client whose
+        circuit breaker has tripped reports itself disabled until the cooldown
+        has passed."""
+        return self.enabled and time.time() >= self._open_until
+
+    def record_success(self):
+        """Resets the circuit breaker after a successful call."""
+        self._fail_count = 0
+
+    def record_failure(self):
+        """Counts one failed call towards the circuit breaker. After
+        fail_threshold consecutive failures the breaker trips and is_enabled()
+        returns False for the next fail_cooldown seconds."""
+        self._fail_count += 1
+        if self.fail_threshold is not None and self._fail_count >= self.fail_threshold:
+            self._open_until = time.time() + self.fail_cooldown
+            self._fail_count = 0
 
     def _connect(self):
         """Initializes the socket, transport, protocol, and session for
-        the Thrift service."""
+        the Thrift service. Returns a _Connection entry, built once and
+        then reused across calls through the pool."""
         self.socket = TSocket.TSocket(self.host, self.port)
         self.socket.setTimeout(self.timeout)
         transport = TTransport.TBufferedTransport(self.socket)
@@ -119,7 +251,39 @@ class SimpleClient(threading.local):
         protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
         client = self.protocol.Client(protocol)
         transport.open()
-        return client
+        self._set_socket_opts(self.socket.handle)
+        conn = _Connection(client, transport, self.socket)
+        try:
+            conn.local_addr = self.socket.handle.getsockname()
+        except socket.error:
+            pass
+        self._local_addr = conn.local_addr
+        return conn
+
+    def current_local_addr(self):
+        """Returns the cached (host, port) this client's most recently
+        established connection is bound to locally, or None before the first
+        connect. Reads the value cached at connect time rather than making a
+        getsockname call."""
+        return self._local_addr
+
+    def _set_socket_opts(self, handle):
+        """Tunes a freshly connected socket for small-message RPC traffic.
+        TCP_NODELAY turns off Nagle's algorithm, which otherwise delays
+        sub-MTU requests waiting for an ACK; SO_KEEPALIVE lets dead peers be
+        noticed on idle pooled connections; TCP_QUICKACK is set where the
+        platform offers it. Tuples from the socket_opts constructor argument
+        are applied on top."""
+        try:
+            handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handle.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            quickack = getattr(socket, 'TCP_QUICKACK', None)
+            if quickack is not None:
+                handle.setsockopt(socket.IPPROTO_TCP, quickack, 1)
+        except socket.error:
+            pass # Never fail a connect over an unsupported option.
+        for level, option, value in self.socket_opts:
+            handle.setsockopt(level, option, value)
 
     def _connect_file(self):
         """Initializes the transport of the Thrift service to write to a
@@ -132,40 +296,134 @@ class SimpleClient(threading.local):
         transport.open()
         return client
 
-    def __getattr__(self, k):
-        """Proxy function for executing Thrift calls. Client will initialize
-        the connection to the remote host or file, execute the command, and
-        then close the socket. Because the socket is created on every request,
-        every individual request is thread-safe (on the client level.) Raises
-        an error on transport or Thrift errors."""
+    def _acquire(self):
+        """Returns a warm _Connection from the pool, or opens a new one if
+        the pool is empty. Entries whose transport has gone stale or that are
+        older than the keepalive TTL are discarded rather than reused."""
+        with self._pool_lock:
+            while self._pool:
+                conn = self._pool.pop()
+                if not conn.is_open():
+                    conn.close()
+                    continue
+                if self.keepalive is None or time.time() - conn.created < self.keepalive:
+                    return conn
+                conn.close()
+        return self._connect()
+
+    def _release(self, conn):
+        """Returns a connection to the pool for reuse by a later call. Closed
+        connections are dropped, and if the pool is already at max_conn the
+        connection is closed instead."""
+        if not conn.is_open():
+            conn.close()
+            return
+        with self._pool_lock:
+            if len(self._pool) < self.max_conn:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def _pipeline(self, calls):
+        """Executes a list of (method, args, kwargs) calls on a single pooled
+        connection, writing every request before reading any reply so that the
+        batch costs roughly one round trip. Returns the return values in call
+        order. Replies are matched to requests by the write order guaranteed
+        by the protocol. Methods without a recv_ counterpart (oneway) yield
+        None."""
+        if not self.is_enabled():
+            raise ClientDisabledError()
+        try:
+            conn = self._acquire()
+        except _RPC_ERRORS:
+            self.record_failure()
+            raise
+        client = conn.client
+        try:
+            for k, args, kwargs in calls:
+                getattr(client, 'send_' + k)(*args, **kwargs)
+            rets = []
+            for k, args, kwargs in calls:
+                recv = getattr(client, 'recv_' + k, None)
+                rets.append(recv() if recv else None)
+        except _RPC_ERRORS:
+            conn.close()
+            self.record_failure()
+            raise
+        except:
+            conn.close()
+            raise
+        self._release(conn)
+        self.record_success()
+        return rets
+
+    def close(self):
+        """Closes all pooled connections. The client remains usable; the next
+        call simply opens a fresh connection."""
+        with self._pool_lock:
+            while self._pool:
+                self._pool.pop().close()
+
+    def _make_dispatcher(self, k):
+        """Builds the dispatcher for the Thrift call named 'k'. The dispatcher
+        checks the connection pool for a warm connection to the remote host, or
+        initializes a new one, and executes the command. The connection is
+        returned to the pool on success, so repeated calls skip the connect()
+        handshake; it is closed and discarded if the call raises. Connections
+        are pooled per-thread, so every individual request is thread-safe (on
+        the client level.) Raises an error on transport or Thrift errors."""
         def f(*args, **kwargs):
             if not self.is_enabled():
                 raise ClientDisabledError()
-            if self.file:
-                client_file = self._connect_file()
+            if self._file_client is not None:
+                with self._file_lock:
+                    try:
+                        getattr(self._file_client, k)(*args, **kwargs)
+                    except _RPC_ERRORS, e:
+                        # Errors are thrown after writing; the record made it
+                        # into the log, so just note the failure and move on.
+                        _log.debug('Error logging %s to file: %r', k, e)
+
+            try:
+                conn = self._acquire()
+            except _RPC_ERRORS:
+                self.record_failure()
+                raise
             try:
-                getattr(client_file, k)(*args, **kwargs)
+                ret = getattr(conn.client, k)(*args, **kwargs)
+            except _RPC_ERRORS:
+                conn.close()
+                self.record_failure()
+                raise
             except:
-                pass # Errors are throwm after writing, simply ignore them.
-
-            client = self._connect()
-            ret = getattr(client, k)(*args, **kwargs)
-            self.socket.close()
+                conn.close()
+                raise
+            self._release(conn)
+            self.record_success()
             return ret
 
         return f
 
+    def __getattr__(self, k):
+        """Fallback for method names not primed at construction; builds the
+        dispatcher on first access and memoizes it so future lookups skip
+        __getattr__ and reuse the same closure."""
+        f = self._make_dispatcher(k)
+        if not k.startswith('_'):
+            self.__dict__[k] = f
+        return f
+
     def __str__(self):
-        return '<%s client %s:%d>' % (self.protocol.__name__, self.host, self.port)
+        return self._repr
 
     def __repr__(self):
-        return str(self)
+        return self._repr
 
     def __nonzero__(self):
         return True
 
     def __hash__(self):
-        return hash((self.host, self.port, self.protocol))
+        return self._hash
 
     def __eq__(self, rhs):
         return (isinstance(rhs, SimpleClient) and
@@ -179,6 +437,9 @@ class MultiClient():
         self.timeout = timeout
         self.servers = []
         self.server_dict = {}
+        # (host, port) -> list of servers at that address, so lookup and
+        # removal by address need not scan the whole server list.
+        self._by_addr = {}
 
     def random_server(self):
         """Returns a random server from the pool."""
@@ -195,11 +456,10 @@ class MultiClient():
                 raise InvalidServerName('No server named: %r' % name)
         elif host and port:
             host, port = _canonicalize_hostport(host, port)
-            for server in self.servers:
-                if (server.host, server.port) == (host, port):
-                    return server
-            else:
-                raise InvalidServerName('No server named: %r' % name)
+            servers = self._by_addr.get((host, port))
+            if servers:
+                return servers[0]
+            raise InvalidServerName('No server at %s:%d' % (host, port))
         else:
             raise InvalidServerName('No server identifier given.')
 
@@ -213,6 +473,7 @@ class MultiClient():
         if name in self.server_dict:
             raise ValueError('Duplicate server name in server pool.')
         self.server_dict[server.name] = server
+        self._by_addr.setdefault((server.host, server.port), []).append(server)
         return server
 
     def remove_server(self, server=None, name=None, host=None, port=None):
@@ -221,36 +482,148 @@ class MultiClient():
         if server:
             self.servers.remove(server)
             del self.server_dict[server.name]
+            addr = (server.host, server.port)
+            servers = self._by_addr.get(addr)
+            if servers and server in servers:
+                servers.remove(server)
+                if not servers:
+                    del self._by_addr[addr]
         elif name:
             server = self.get_server(name=name)
             self.remove_server(server=server)
         else:
             host, port = _canonicalize_hostport(host, port)
-            to_remove = [s for s in self.servers if (host, port) == (s.host, s.port)]
-            for server in to_remove:
+            for server in self._by_addr.pop((host, port), []):
                 self.servers.remove(server)
                 del self.server_dict[server.name]
 
+class _BoundRPC(object):
+    """Callable standing in for one RPC method on a pool client: calling it
+    runs the owning client's _invoke with the bound method name. Unlike the
+    closure it replaces, it is a small slotted object, so memoized
+    dispatchers carry no closure cells and repeated fan-outs allocate
+    nothing per lookup."""
+    __slots__ = ('_client', '_name')
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        return self._client._invoke(self._name, args, kwargs)
+
+    def __repr__(self):
+        return '<bound rpc %s of %r>' % (self._name, self._client)
+
+class _Pipeline():
+    """Proxy returned by ReplicatedClient.pipeline(). Method calls made on
+    the proxy inside the with-block are queued rather than executed; when the
+    block exits, every server receives all queued calls back-to-back on one
+    connection before any reply is read. After exit, the responses attribute
+    holds one list of ThriftResponse objects per queued call, in call order."""
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+        self.responses = None
+
+    def __getattr__(self, k):
+        def f(*args, **kwargs):
+            self._calls.append((k, args, kwargs))
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.responses = self._client._run_pipeline(self._calls)
+        return False
+
 class ReplicatedClient(MultiClient):
     """Returns a new instance of the ReplicatedClient class. The ReplicatedClient represents
     a pool of servers all of whom expect to get every Thrift call called on the client. To
     add servers to the pool, call add_server(host, port) on the ReplicatedClient."""
+    def __init__(self, protocol, frame=False, timeout=None):
+        MultiClient.__init__(self, protocol, frame, timeout)
+        _prime_dispatchers(self, protocol)
+
+    def pipeline(self):
+        """Returns a context manager that batches method calls. Instead of
+        paying one round trip per call per server, all queued calls to a
+        server share one connection and one round trip. Use as:
+
+            with pool.pipeline() as p:
+                p.setk('a', '1')
+                p.setk('b', '2')
+            responses = p.responses"""
+        return _Pipeline(self)
+
+    def _pipeline_server(self, server, calls):
+        """Runs the queued pipeline calls against one server, wrapping each
+        result in a ThriftResponse. A transport failure mid-batch marks every
+        call for that server as errored."""
+        try:
+            rets = server._pipeline(calls)
+            return [ThriftResponse(server, ret) for ret in rets]
+        except Exception, e:
+            return [ThriftExceptionResponse(server, e) for _ in calls]
+
+    def _run_pipeline(self, calls):
+        """Executes the queued calls against every server in the pool and
+        regroups the per-server results into one response list per call."""
+        by_server = [self._pipeline_server(server, calls) for server in self.servers]
+        return [list(per_call) for per_call in zip(*by_server)]
+
+    def iter(self, method, *args, **kwargs):
+        """Calls the named method on every server, yielding each
+        ThriftResponse as soon as it is available instead of waiting for the
+        whole fan-out, so callers can act on early results or stop once they
+        have seen enough. This serial client yields in server order;
+        ThreadedReplicatedClient yields in completion order."""
+        for server in self.servers:
+            try:
+                yield ThriftResponse(server, getattr(server, method)(*args, **kwargs))
+            except Exception, e:
+                yield ThriftExceptionResponse(server, e)
+
+    def quorum(self, n, method, *args, **kwargs):
+        """Returns the first n successful responses to the named call,
+        abandoning the rest of the fan-out once the quorum is met. If fewer
+        than n servers succeed, returns however many successes there were."""
+        successes = []
+        for response in self.iter(method, *args, **kwargs):
+            if response is not None and not response.is_error():
+                successes.append(response)
+                if len(successes) >= n:
+                    break
+        return successes
+
+    def _invoke(self, k, args, kwargs):
+        """Proxies the function call with name 'k' to all of the servers added
+        to the pool. The return result is a list of ThriftResponse objects,
+        which contain the responses of each of the server, as well as the
+        server that was hit. If there was an Exception raised by a server, a
+        ThriftExceptionResponse object is returned instead."""
+        responses = []
+        for server in self.servers:
+            try:
+                response = ThriftResponse(server, getattr(server, k)(*args, **kwargs))
+            except Exception, e:
+                response = ThriftExceptionResponse(server, e)
+            responses.append(response)
+        return responses
+
+    def _make_dispatcher(self, k):
+        """Builds the dispatcher for the call named 'k': a _BoundRPC routing
+        through _invoke, so subclasses only override the invocation."""
+        return _BoundRPC(self, k)
 
     def __getattr__(self, k):
-        """Proxies the request for the function with name 'k' to all of the servers added
-        to the pool. The return result is a list of ThriftResponse objects, which contain
-        the responses of each of the server, as well as the server that was hit. If there
-        was an Exception raised by a server, a ThriftExceptionResponse object is returned
-        instead."""
-        def f(*args, **kwargs):
-            responses = []
-            for server in self.servers:
-                try:
-                    response = ThriftResponse(server, getattr(server, k)(*args, **kwargs))
-                except Exception, e:
-                    response = ThriftExceptionResponse(server, e)
-                responses.append(response)
-            return responses
+        """Fallback for method names not primed at construction; builds the
+        dispatcher on first access and memoizes it."""
+        f = self._make_dispatcher(k)
+        if not k.startswith('_'):
+            self.__dict__[k] = f
         return f
 
     def __str__(self):
@@ -259,35 +632,219 @@ class ReplicatedClient(MultiClient):
     def __repr__(self):
         return str(self)
 
+class _Future(object):
+    """Placeholder for the eventual result of a call submitted to a
+    _WorkerPool. result() blocks until the worker finishes, then returns
+    the value or reraises the exception raised by the call. Allocated once
+    per server per threaded fan-out, hence slotted."""
+    __slots__ = ('_done', '_result', '_exception')
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def result(self):
+        """Blocks until the submitted call has run, then returns its value
+        or raises the exception it raised."""
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class _WorkerPool():
+    """Fixed pool of daemon worker threads fed from a single queue. The
+    threads are started once and reused across calls, so submitting work
+    does not pay the thread-creation cost on every RPC."""
+    def __init__(self, size):
+        self.queue = Queue.Queue()
+        self.size = 0
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    def resize(self, size):
+        """Grows the pool to the given number of worker threads. The pool
+        never shrinks; extra workers simply sit idle on the queue."""
+        with self._lock:
+            while self.size < size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.size += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) to run on a worker thread. Returns
+        a _Future holding its eventual result."""
+        future = _Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """Stops all worker threads once the queued work has drained."""
+        with self._lock:
+            for _ in xrange(self.size):
+                self.queue.put(None)
+            self.size = 0
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception, e:
+                future.set_exception(e)
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool():
+    """Returns the single worker pool shared by the whole process, creating
+    it lazily on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = _WorkerPool(4)
+        return _process_pool
+
 class ThreadedReplicatedClient(ReplicatedClient):
     """Returns a new instance of the ThreadedReplicatedClient class. A
     ThreadedReplicatedClient is identical to a ReplicatedClient, except that function calls
-    are executed by threads instead of serially."""
-    def __getattr__(self, k):
-        def f(*args, **kwargs):
-            responses = []
-            def get_response(server):
-                try:
-                    response = ThriftResponse(server, getattr(server, k)(*args, **kwargs))
-                except Exception, e:
-                    response = ThriftExceptionResponse(server, e)
-                # list.append() is thread-safe
-                responses.append(response)
-
-            threads = []
-            for server in self.servers:
-                threads.append(threading.Thread(target=get_response, args=(server,)))
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
-            return responses
+    are executed by a shared pool of worker threads instead of serially. pool_size fixes
+    the number of workers; by default the pool grows with the number of servers."""
+    def __init__(self, protocol, frame=False, timeout=None, pool_size=None):
+        ReplicatedClient.__init__(self, protocol, frame, timeout)
+        self.pool_size = pool_size
+        self._pool = _WorkerPool(pool_size or 4)
 
-        return f
+    def add_server(self, host=None, port=None, server=None, name=None):
+        """Adds a server to the client pool, growing the worker pool to match
+        the server count so a full fan-out never waits on a busy worker."""
+        server = ReplicatedClient.add_server(self, host, port, server, name)
+        if self.pool_size is None:
+            self._pool.resize(max(4, len(self.servers)))
+        return server
+
+    def shutdown(self):
+        """Stops the worker threads. The client should not be used afterwards."""
+        self._pool.shutdown()
+
+    def _run_pipeline(self, calls):
+        """Executes the queued pipeline calls against every server in
+        parallel on the worker pool, one connection per server."""
+        futures = [self._pool.submit(self._pipeline_server, server, calls)
+                   for server in self.servers]
+        by_server = [future.result() for future in futures]
+        return [list(per_call) for per_call in zip(*by_server)]
+
+    def _submit_all(self, k, args, kwargs):
+        """Submits the call named 'k' against every server to the worker pool
+        and returns the futures in server order. Each future resolves to a
+        ThriftResponse (or ThriftExceptionResponse) and never raises."""
+        def call(server):
+            try:
+                return ThriftResponse(server, getattr(server, k)(*args, **kwargs))
+            except Exception, e:
+                return ThriftExceptionResponse(server, e)
+
+        return [self._pool.submit(call, server) for server in self.servers]
+
+    def _invoke(self, k, args, kwargs):
+        """Fans the call named 'k' out to every server on the worker pool and
+        collects the responses in server order."""
+        futures = self._submit_all(k, args, kwargs)
+        return [future.result() for future in futures]
+
+    def _stream(self, method, args, kwargs, cancelled):
+        """Submits the call to every server on the worker pool and yields
+        responses in completion order. cancelled is a mutable flag checked
+        before a queued call starts; once set, not-yet-started work is
+        skipped cheaply and yielded as None."""
+        done = Queue.Queue()
+
+        def call(server):
+            if cancelled:
+                done.put(None)
+                return
+            try:
+                done.put(ThriftResponse(server, getattr(server, method)(*args, **kwargs)))
+            except Exception, e:
+                done.put(ThriftExceptionResponse(server, e))
+
+        count = len(self.servers)
+        for server in self.servers:
+            self._pool.submit(call, server)
+        for _ in xrange(count):
+            yield done.get()
+
+    def iter(self, method, *args, **kwargs):
+        """Calls the named method on every server via the worker pool,
+        yielding each ThriftResponse in completion order, so one slow replica
+        does not hold up responses that are already in. End-to-end latency to
+        the last response is max(RTT) rather than sum(RTT)."""
+        return self._stream(method, args, kwargs, [])
+
+    def quorum(self, n, method, *args, **kwargs):
+        """Returns the first n successful responses to the named call in
+        completion order. Once the quorum is met, queued calls that have not
+        started yet are skipped; calls already on the wire run to completion
+        but are not waited on. If fewer than n servers succeed, returns
+        however many successes there were."""
+        cancelled = []
+        successes = []
+        for response in self._stream(method, args, kwargs, cancelled):
+            if response is not None and not response.is_error():
+                successes.append(response)
+                if len(successes) >= n:
+                    cancelled.append(True)
+                    break
+        return successes
 
     def __str__(self):
         return '<threaded replicated %r>' % self.servers
 
+class AsyncReplicatedClient(ThreadedReplicatedClient):
+    """Returns a new instance of the AsyncReplicatedClient class. Identical to a
+    ThreadedReplicatedClient except that function calls return immediately with
+    a list of futures, one per server, instead of blocking until every server
+    has answered. Callers can overlap many fan-outs and collect the results
+    later with gather(). All AsyncReplicatedClients in a process share one
+    lazily created worker pool, so the number of threads stays fixed no matter
+    how many clients or in-flight fan-outs there are."""
+    def __init__(self, protocol, frame=False, timeout=None):
+        ReplicatedClient.__init__(self, protocol, frame, timeout)
+        self.pool_size = None
+        self._pool = _get_process_pool()
+
+    def gather(self, futures):
+        """Blocks until every future from a previous call has completed and
+        returns their responses, for callers that want plain synchronous
+        results after all."""
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        """The worker pool is shared by the whole process, so shutting down
+        one AsyncReplicatedClient leaves it running."""
+        pass
+
+    def _invoke(self, k, args, kwargs):
+        """Submits the call named 'k' to every server and returns the futures
+        immediately, without waiting on any of them."""
+        return self._submit_all(k, args, kwargs)
+
+    def __str__(self):
+        return '<async replicated %r>' % self.servers
+
 class HashClient(MultiClient):
     """Returns a new instance of the HashClient class. A HashClient represents a pool of
     servers. When a Thrift call comes in, its parameters are hashed, and one of the given
@@ -296,6 +853,11 @@ class HashClient(MultiClient):
         MultiClient.__init__(self, protocol, frame, timeout)
         self.all = ReplicatedClient(protocol, frame, timeout)
         self.hashfns = {}
+        self._key_fns = {}
+        self._num_servers = 0
+        self._ring_hashes = []
+        self._ring_servers = []
+        _prime_dispatchers(self, protocol)
 
     def add_server(self, host=None, port=None, server=None):
         """Adds a server to the client pool. If server is not defined, then a new one
@@ -303,36 +865,109 @@ class HashClient(MultiClient):
         that was just added."""
         server = MultiClient.add_server(self, host, port, server)
         self.all.add_server(server=server)
+        self._num_servers = len(self.servers)
+        self._rebuild_ring()
         return server
 
     def remove_server(self, server=None, host=None, port=None):
         """Removes the server from the pool, or removes the server with the indicated
         host and port from the pool."""
-        MultiClient.remove_server(self, server, host, port)
-        self.all.remove_server(server, host, port)
+        MultiClient.remove_server(self, server=server, host=host, port=port)
+        self.all.remove_server(server=server, host=host, port=port)
+        self._num_servers = len(self.servers)
+        self._rebuild_ring()
+
+    def _rebuild_ring(self):
+        """Rebuilds the consistent-hash ring from the current server list.
+        Each server owns _VIRTUAL_NODES points on the ring, so when a server
+        is added or removed only the keys on its own points move to another
+        server, instead of nearly every key remapping as with plain modulo
+        placement."""
+        ring = []
+        for server in self.servers:
+            for i in xrange(_VIRTUAL_NODES):
+                point = hash('%s:%d#%d' % (server.host, server.port, i))
+                ring.append((point, server))
+        ring.sort()
+        self._ring_hashes = [point for point, server in ring]
+        self._ring_servers = [server for point, server in ring]
+
+    def _server_for(self, hashval):
+        """Returns the server whose ring point follows hashval, wrapping
+        around at the end of the ring."""
+        if _speedups is not None:
+            return _speedups.ring_lookup(self._ring_hashes, self._ring_servers, hashval)
+        index = bisect.bisect(self._ring_hashes, hashval)
+        if index == len(self._ring_servers):
+            index = 0
+        return self._ring_servers[index]
 
     def set_hash(self, fnname, hashfn):
         """Changes the default hash function for the function named 'fnname' to hashfn.
         hashfn() expects the same parameters that the function defined as 'fnname'
         expects."""
         self.hashfns[fnname] = hashfn
+        self._key_fns.pop(fnname, None)
         return self
 
-    def __getattr__(self, k):
-        """Proxy function for executing Thrift calls. When a call is made, the parameters
-        of the function call are hashed, and a corresponding server is chosen to serve
-        the request. If servers are added or removed, it is not guaranteed that future
-        function calls with identical parameters will be sent to the same server. If an
-        Exception is raised, the Exception returned will also contain a server property
-        that represents the server object that served the request."""
+    def _build_key_fn(self, k):
+        """Builds and caches the hash-key function for the method named 'k'.
+        The key function takes the call's (args, kwargs) and returns an int.
+        The default hashes the positional arguments and a frozenset of the
+        keyword items, so no per-call sort or intermediate tuple is needed;
+        a function registered via set_hash takes precedence."""
+        hashfn = self.hashfns.get(k)
+        if hashfn is not None:
+            key_fn = lambda args, kwargs: hash(hashfn(*args, **kwargs))
+        else:
+            key_fn = _default_key_fn
+        self._key_fns[k] = key_fn
+        return key_fn
+
+    def multi(self, method, items, key_fn=None):
+        """Calls the named method once per item, routing each item to its
+        server by hash and batching all items bound for the same server into
+        a single pipelined round trip, so routing costs one pass and each
+        server is hit once instead of once per item. Each item is passed as
+        the method's sole argument. key_fn overrides how an item is hashed;
+        by default the method's hash function (see set_hash) is used. Returns
+        a list of ThriftResponse objects in the same order as items."""
+        items = list(items)
+        if key_fn is None:
+            method_key_fn = self._key_fns.get(method)
+            if method_key_fn is None:
+                method_key_fn = self._build_key_fn(method)
+            key_fn = lambda item: method_key_fn((item,), {})
+        buckets = {}
+        for index, item in enumerate(items):
+            server = self._server_for(key_fn(item))
+            buckets.setdefault(server, []).append((index, item))
+        responses = [None] * len(items)
+        for server, batch in buckets.iteritems():
+            calls = [(method, (item,), {}) for index, item in batch]
+            try:
+                rets = server._pipeline(calls)
+                for (index, item), ret in zip(batch, rets):
+                    responses[index] = ThriftResponse(server, ret)
+            except Exception, e:
+                for index, item in batch:
+                    responses[index] = ThriftExceptionResponse(server, e)
+        return responses
+
+    def _make_dispatcher(self, k):
+        """Builds the dispatcher for the Thrift call named 'k'. When a call is made,
+        the parameters of the function call are hashed, and a corresponding server is
+        chosen from the consistent-hash ring to serve the request. If servers are added
+        or removed, only the keys owned by the changed server move; other parameters
+        keep hitting the same server. If an Exception is raised, the Exception returned
+        will also contain a server property that represents the server object that
+        served the request."""
         def f(*args, **kwargs):
-            if k in self.hashfns:
-                hashkey = self.hashfns[k](*args, **kwargs)
-            else:
-                hashkey = args + tuple(sorted(kwargs.items()))
-            hashval = hash(hashkey)
-            server_index = hashval % len(self.servers)
-            server = self.servers[server_index]
+            key_fn = self._key_fns.get(k)
+            if key_fn is None:
+                key_fn = self._build_key_fn(k)
+            hashval = key_fn(args, kwargs)
+            server = self._server_for(hashval)
             try:
                 ret = getattr(server, k)(*args, **kwargs)
                 response = ThriftResponse(server, ret)
@@ -344,6 +979,14 @@ class HashClient(MultiClient):
         f.set_hash = lambda fn: self.set_hash(k, fn)
         return f
 
+    def __getattr__(self, k):
+        """Fallback for method names not primed at construction; builds the
+        dispatcher on first access and memoizes it."""
+        f = self._make_dispatcher(k)
+        if not k.startswith('_'):
+            self.__dict__[k] = f
+        return f
+
     def __str__(self):
         return '<hash client %r>' % self.servers
 